@@ -3,20 +3,35 @@
 
 # This is the ALICE module for our file-sharing system.
 # Alice is the original sender of the file. She:
-#   1. Splits a large file into smaller chunks
+#   1. Splits a large file into smaller chunks (without copying them to disk)
 #   2. Contacts the tracker to get a list of active peers
 #   3. Sends those chunks to a few selected peers over the network
 
 # Import necessary libraries
+import asyncio
+import hashlib
 import socket
 import json
+import logging
 import os
+import sys
 import time
 
+from protocol import (CHUNK_SIZE, dump_json, pack_manifest, pack_chunk_header, pack_message, read_message,
+                      recv_peer_list, set_cork, tune_socket)
+
 # Allocated IP address and port number of the tracker
 TRACKER_IP = '127.0.0.1'
 TRACKER_PORT = 9090
 
+# Logger for the messages we print once per chunk. They are hidden unless Alice is
+# started with --verbose, so big files are not slowed down by thousands of lines
+log = logging.getLogger(__name__)
+
+# posix_fadvise() lets us tell the kernel how we are going to read a file. It only
+# exists on some systems (not on Windows or macOS)
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+
 # -------------------------------------------------------------------------------------------
 # This function (get_peers) asks the tracker for a list of peers
 def get_peers():
@@ -26,11 +41,10 @@ def get_peers():
             # Connect to the tracker
             s.connect((TRACKER_IP, TRACKER_PORT))
             # Send the request for peers
-            s.sendall(b'GET_PEERS')
-            # Receive and decode the peer list as JSON
-            response = s.recv(4096).decode()
-            print(f"Received peer list: {response}")
-            peers = json.loads(response)
+            s.sendall(pack_message(b'GET_PEERS'))
+            # Receive and decode the peer list
+            peers = recv_peer_list(s)
+            print(f"Received peer list: {peers}")
             # Return the list of peers
             return peers
     except Exception as e:
@@ -39,26 +53,16 @@ def get_peers():
         return []
 
 # -------------------------------------------------------------------------------------------
-# This function (split_file) splits a big file into smaller chunks and saves them 
-# in a "chunks" folder.
+# This function (split_file) splits a big file into smaller chunks.
+# The chunks are not copied anywhere: each one is just a name plus the offset and size
+# of its data inside the original file, and send_chunks_to_peer() sends that part of
+# the file directly. This saves writing the whole file to disk and reading it back.
 # Here, we have chosen the default chunk size to be 1 MB
-def split_file(file_path, chunk_size=1024 * 1024):  
-    # Directory where we save the chunks
-    chunks_dir = "chunks"
-    # Clear existing chunks from previous runs
-    if os.path.exists(chunks_dir):
-        for filename in os.listdir(chunks_dir):
-            file_path_to_delete = os.path.join(chunks_dir, filename)
-            if os.path.isfile(file_path_to_delete):
-                os.remove(file_path_to_delete)
-    # Create the chunks folder if it doesn't exist
-    else:
-        os.makedirs(chunks_dir)
-
+def split_file(file_path, chunk_size=CHUNK_SIZE):  
     # Verify that the file exists. If not, we display an error
     if not os.path.exists(file_path):
         print(f"Error: File {file_path} not found")
-        return []
+        return None, []
 
     # Check file size (this is an additional chekc, where if it is 0, we return that file is empty)
     file_size = os.path.getsize(file_path)
@@ -71,138 +75,166 @@ def split_file(file_path, chunk_size=1024 * 1024):
     # Get original file extension 
     _, file_extension = os.path.splitext(file_path)
     
-    # Create a metadata file which will store filename and extension of original file
+    # Create the metadata which will store filename and extension of original file
     file_metadata = {
         "original_filename": os.path.basename(file_path),
         "extension": file_extension,
         "size": file_size,
-        "chunk_count": 0  
+        "chunk_count": 0,
+        # SHA-256 of every chunk, so whoever downloads it can check it arrived intact
+        "chunk_digests": {}
     }
 
     # Print message to infrom user we are splitting the files
     print(f"Splitting file: {file_path} ({file_size} bytes) with extension: {file_extension}")
 
-    # List to store chunk file names 
+    # List of (chunk name, offset, size) for every chunk
     chunks = []
-    
-    # Open the file in read mode
+    # Read the file once to hash the chunks. We read every chunk into the same buffer,
+    # instead of allocating a new 1 MB bytes object each time
+    buf = memoryview(bytearray(chunk_size))
     with open(file_path, "rb") as f:
-        # Chunk counter
-        i = 0
-        while True:
-            # Read a chunk from the file
-            chunk = f.read(chunk_size)
-            # If no more data, we're done
-            if not chunk:
-                break
-                
+        # We read the file from start to end, so ask the kernel to read ahead further
+        if HAS_FADVISE:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for i, offset in enumerate(range(0, file_size, chunk_size)):
             # Create the chunk file name
             chunk_name = f"chunk_{i}.part"
-            chunk_path = os.path.join(chunks_dir, chunk_name)
-            
-            # Open the chunk file in write mode
-            with open(chunk_path, "wb") as chunk_file:
-                # Write the chunk data to the file
-                chunk_file.write(chunk)
-                
-            # Add just the chunk name to the list 
-            chunks.append(chunk_name)
-            
-            # Display a message for user to stay updated
-            print(f"Chunk created: {chunk_name} ({len(chunk)} bytes)")
-            i += 1
-
-    # Update metadata with chunk count and save it
-    file_metadata["chunk_count"] = i
-    metadata_path = os.path.join(chunks_dir, "file_metadata.json")
-    with open(metadata_path, "w") as metadata_file:
-        json.dump(file_metadata, metadata_file)
-    
-    # Add metadata file to chunks list
-    chunks.append("file_metadata.json")
+            size = f.readinto(buf)
+            chunks.append((chunk_name, offset, size))
+            file_metadata["chunk_digests"][chunk_name] = hashlib.sha256(buf[:size]).hexdigest()
+            # Log the chunk (only shown with --verbose)
+            log.debug("Chunk created: %s (%d bytes)", chunk_name, size)
+
+    # Update metadata with chunk count
+    file_metadata["chunk_count"] = len(chunks)
     
     # Notify the user
-    print(f"Finished splitting file – total chunks: {i}")
-    print(f"Metadata saved with original filename: {file_metadata['original_filename']} and extension: {file_metadata['extension']}")
+    print(f"Finished splitting file – total chunks: {len(chunks)}")
+    print(f"Metadata created with original filename: {file_metadata['original_filename']} and extension: {file_metadata['extension']}")
     
-    # Return the list of chunk names
-    return chunks
+    # Return the metadata and the list of chunks
+    return file_metadata, chunks
 
 # -------------------------------------------------------------------------------------------
-# This function (send_chunks_to_peer) sends all the chunks from the "chunks" folder to 
-# the specified peer.
-def send_chunks_to_peer(peer_ip, peer_port):
-    # Get and sort the chunk file names
-    chunks_dir = "chunks"
-    if not os.path.exists(chunks_dir):
-        print(f"Error: Chunks directory {chunks_dir} not found")
-        return False
-    chunks = sorted(os.listdir(chunks_dir))
-    
-    # Move metadata file to the end to ensure it's processed last
-    if "file_metadata.json" in chunks:
-        chunks.remove("file_metadata.json")
-        chunks.append("file_metadata.json")
-    
-    # Check if there are any chunks to send.
-    if not chunks:
-        print("No chunks found to send")
-        return False
+# This function (persist_chunks) writes every chunk, and the metadata, to its own file in
+# "chunks_dir". Alice does not need these files to share a file, they are only written
+# when she is started with --persist-chunks, to look at what is being sent.
+def persist_chunks(file_path, file_metadata, chunks, chunks_dir="chunks"):
+    os.makedirs(chunks_dir, exist_ok=True)
+    # Remove chunks left over from an earlier file, so only this file's chunks are kept
+    with os.scandir(chunks_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                os.remove(entry.path)
+    with open(file_path, "rb") as src:
+        for chunk_name, offset, size in chunks:
+            src.seek(offset)
+            with open(os.path.join(chunks_dir, chunk_name), "wb") as chunk_file:
+                chunk_file.write(src.read(size))
+    with open(os.path.join(chunks_dir, "file_metadata.json"), "w") as f:
+        json.dump(file_metadata, f)
+    print(f"Wrote {len(chunks)} chunks and file_metadata.json to {chunks_dir}/")
+
+# -------------------------------------------------------------------------------------------
+# This function (send_chunks_to_peer) sends all the chunks of the file, followed by the
+# file metadata, to the specified peer. All chunks go over one connection: a manifest
+# listing them, then one frame per chunk (see protocol.py). This way we only pay for the
+# TCP handshake and READY_ACK once per peer.
+async def send_chunks_to_peer(peer_ip, peer_port, file_path, file_metadata, chunks):
+    # The metadata goes last, so the peer has every chunk by the time it gets it
+    metadata = dump_json(file_metadata)
+    manifest = [[chunk_name, size] for chunk_name, _, size in chunks]
+    manifest.append(["file_metadata.json", len(metadata)])
 
-    print(f"Preparing to send {len(chunks)} chunks to {peer_ip}:{peer_port}")
+    print(f"Preparing to send {len(manifest)} chunks to {peer_ip}:{peer_port}")
     
     # Counter for the successfully sent chunks
     success_count = 0
-    for chunk_file in chunks:
-    	# Initiliaze the path to the chunk file.
-        chunk_path = os.path.join(chunks_dir, chunk_file)
-        
-        # Skip if not a file or empty
-        if not os.path.isfile(chunk_path) or os.path.getsize(chunk_path) == 0:
-            print(f"Skipping {chunk_file} - not a valid file")
-            continue
-            
-        # Create a socket for each chunk
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                # Connect to the peer
-                s.connect((peer_ip, int(peer_port)))
-                # Send a handshake message
-                s.sendall(b'READY_TO_SEND')
-                # Wait for acknowledgement
-                ack = s.recv(1024)
-                # If acknowledgement is incorrect
-                if ack != b'READY_ACK':
-                    print(f"{peer_ip}:{peer_port} isn't ready. Got: {ack}. Skipping...")
-                    continue
-
-                # Send the chunk file name
-                s.sendall(os.path.basename(chunk_file).encode())
-                # Small delay to ensure the peer is ready
-                time.sleep(0.1)
-                # Send the chunk data
-                with open(chunk_path, "rb") as f:
-                    data = f.read()
-                    s.sendall(data)
-                
-                # Close the connection when we are done
-                s.shutdown(socket.SHUT_WR)
-                
-                # Output message and incrementing the success counter for chunks
-                print(f"Sent {chunk_file} to {peer_ip}:{peer_port} ({os.path.getsize(chunk_path)} bytes)")
+    try:
+        # Connect to the peer on a socket tuned for bulk transfers
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_socket(s)
+        s.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(s, (peer_ip, int(peer_port)))
+        except OSError:
+            s.close()
+            raise
+        reader, writer = await asyncio.open_connection(sock=s)
+    except OSError as e:
+        print(f"Couldn't connect to {peer_ip}:{peer_port} – Error: {e}")
+        return False
+
+    try:
+        # Send a handshake message and wait for acknowledgement
+        writer.write(pack_message(b'READY_TO_SEND'))
+        await writer.drain()
+        ack = await read_message(reader)
+        # If acknowledgement is incorrect
+        if ack != b'READY_ACK':
+            print(f"{peer_ip}:{peer_port} isn't ready. Got: {ack}. Skipping...")
+            return False
+
+        # Cork the socket while we stream, so each frame header goes out in the same
+        # segment as the start of its chunk data instead of on its own
+        set_cork(s, True)
+        # Send the manifest, then stream the chunks back-to-back
+        writer.write(pack_manifest(manifest))
+        loop = asyncio.get_running_loop()
+        # Open the original file once for all the chunks
+        with open(file_path, "rb") as f:
+            for chunk_name, offset, size in chunks:
+                # Send the frame header: chunk name and data size
+                writer.write(pack_chunk_header(chunk_name, size))
+                # Send the chunk's part of the file straight to the socket. The event
+                # loop uses sendfile() for this, so the data never goes through Python
+                await loop.sendfile(writer.transport, f, offset, size)
+
+                # Log the chunk and increment the success counter for chunks
+                log.debug("Sent %s to %s:%d (%d bytes)", chunk_name, peer_ip, peer_port, size)
                 success_count += 1
-                
-            except Exception as e:
-                print(f"Couldn't send {chunk_file} to {peer_ip}:{peer_port} – Error: {e}")
+
+        # Send the metadata from memory
+        writer.write(pack_chunk_header("file_metadata.json", len(metadata)) + metadata)
+        print(f"Sent file_metadata.json to {peer_ip}:{peer_port} ({len(metadata)} bytes)")
+        success_count += 1
+        # Send whatever the cork is still holding back
+        await writer.drain()
+        set_cork(s, False)
+
+        # Tell the peer we have nothing more to send and wait for it to close the
+        # connection, which it does once it has saved every chunk in the manifest
+        writer.write_eof()
+        await reader.read()
+
+    except Exception as e:
+        print(f"Couldn't send chunks to {peer_ip}:{peer_port} – Error: {e}")
+    finally:
+        # Close the connection when we are done
+        writer.close()
 
     # Output user for the user if all chunks sent succesfully
-    print(f"Successfully sent {success_count} of {len(chunks)} chunks to {peer_ip}:{peer_port}")
+    print(f"Successfully sent {success_count} of {len(manifest)} chunks to {peer_ip}:{peer_port}")
     # Return True if at least one chunk was sent successfully.
     return success_count > 0
 
+# -------------------------------------------------------------------------------------------
+# This function (send_chunks_to_peers) sends the chunks to all the given peers at the
+# same time, so a slow peer does not hold up the others.
+async def send_chunks_to_peers(peers, file_path, file_metadata, chunks):
+    tasks = []
+    for ip, port in peers:
+        print(f"Sending chunks to {ip}:{port}...")
+        tasks.append(send_chunks_to_peer(ip, port, file_path, file_metadata, chunks))
+    return await asyncio.gather(*tasks)
+
 # -----------------------------------------------------------------------------------------
 # Main program
 if __name__ == "__main__":
+    # Show the per-chunk messages if asked to
+    if "--verbose" in sys.argv:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     # Get the file path from the user
     file_path = input("Enter file path to share: ").strip()
     # Check if file exists
@@ -211,10 +243,13 @@ if __name__ == "__main__":
         exit(1)
      
     # Split the file into chunks
-    chunks = split_file(file_path)
-    if not chunks:
+    file_metadata, chunks = split_file(file_path)
+    if file_metadata is None:
         print("No chunks were created. Check if the file is valid.")
         exit(1)
+    # Keep a copy of the chunks on disk for debugging, if asked to
+    if "--persist-chunks" in sys.argv:
+        persist_chunks(file_path, file_metadata, chunks)
 
     # Wait for peers to register
     print("Waiting for peers to register with tracker...")
@@ -230,12 +265,8 @@ if __name__ == "__main__":
     peer_count = min(2, len(peers))
     print(f"Sending chunks to {peer_count} peers: {peers[:peer_count]}")
     
-    for peer in peers[:peer_count]:  
-        print(f"Sending chunks to {peer}...")
-        # Extract IP and port from the peer info
-        ip, port = peer.split(":")
-        # Send chunks to the peer
-        send_chunks_to_peer(ip, port)
+    # Send chunks to the peers
+    asyncio.run(send_chunks_to_peers(peers[:peer_count], file_path, file_metadata, chunks))
 
     # Final message if a success for all required in PART 1
     print("File sharing complete!")
\ No newline at end of file
@@ -10,14 +10,28 @@
 
 # Import necessary libraries
 import socket
+import hashlib
 import json
+import logging
 import os
 import shutil
+import sys
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from bufferpool import BufferPool
+from protocol import (CHUNK_FOUND, CHUNK_NOT_FOUND, CHUNK_SIZE, RECV_WAITALL, USE_SPLICE, file_sha256,
+                      manifest_parts, pack_message, recv_chunk_header, recv_exact, recv_manifest, recv_message,
+                      recv_peer_list, send_parts, splice_to_file, tune_socket)
 
 # Tracker's IP and Port Number 
 TRACKER_IP = '127.0.0.1'
 TRACKER_PORT = 9090
 
+# Logger for the messages we print once per chunk. They are hidden unless Bob is
+# started with --verbose, so big files are not slowed down by thousands of lines
+log = logging.getLogger(__name__)
+
 # Setting up the directory for the downloaded chnuks
 DOWNLOAD_DIR = 'bob_downloads'
 if not os.path.exists(DOWNLOAD_DIR):
@@ -26,6 +40,21 @@ if not os.path.exists(DOWNLOAD_DIR):
 # Reconstructed File Path
 OUTPUT_FILE = os.path.join(DOWNLOAD_DIR, 'reconstructed_file')
 
+# Linux can sendfile() between two regular files, other systems need a socket
+USE_SENDFILE = hasattr(os, "sendfile") and sys.platform.startswith("linux")
+# Buffer size used when we have to copy chunk data in Python
+COPY_BUFFER_SIZE = 1024 * 1024
+# posix_fadvise() lets us tell the kernel how we are going to use a file. It only
+# exists on some systems (not on Windows or macOS)
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+# Buffer size used when receiving chunk data from a peer. It holds a whole chunk, and
+# the socket's receive buffer holds several (see tune_socket), so a single
+# recv_into() can take a whole chunk the kernel has queued for us
+RECV_BUFFER_SIZE = CHUNK_SIZE
+# Pool of receive buffers shared by the download threads, so every download reuses
+# memory we already have
+recv_pool = BufferPool(RECV_BUFFER_SIZE, 8)
+
 # ----------------------------------------------------------------------------------
 # This function (get_peer_list) asks the tracker for list of available peers
 def get_peer_list():
@@ -35,99 +64,141 @@ def get_peer_list():
             # Connect to the tracker
             s.connect((TRACKER_IP, TRACKER_PORT))
             # Send a request to get the peer list
-            s.sendall(b'GET_PEERS')
-            # Receive the peer list data from the tracker
-            peer_data = s.recv(4096).decode()
-            # Parse the received JSON data and return the peer list
-            print(f"Received peer data: {peer_data}")
-            return json.loads(peer_data)
+            s.sendall(pack_message(b'GET_PEERS'))
+            # Receive the peer list from the tracker and return it
+            peers = recv_peer_list(s)
+            print(f"Received peer data: {peers}")
+            return peers
         except Exception as e:
             print(f"Error getting peer list: {e}")
             # Return an empty list if an error occurs
             return []
 
 # ----------------------------------------------------------------------------------
-# This function (request_chunks_from_peer) asks a peer for the chunks it has
-def request_chunks_from_peer(peer_ip, peer_port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        try:
-             # Connect to the peer
-            s.connect((peer_ip, peer_port))
-            # Send a request to get the chunk list
-            s.sendall(b'REQUEST_CHUNKS')  
-            # Receive it
-            response = s.recv(4096).decode()
-            # Print the received chunk list
-            print(f"Received chunk list from {peer_ip}:{peer_port}: {response}")
-            chunk_list = json.loads(response) 
-            # Return the chunk list.
-            return chunk_list
-        except Exception as e:
-            # Print an error message if an exception occurs.
-            print(f"Failed to connect to {peer_ip}:{peer_port} – {e}")
-            return []
+# This function (open_peer) opens a connection to a peer. Bob keeps one connection
+# per peer for both the chunk list and the chunk downloads.
+def open_peer(peer_ip, peer_port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        tune_socket(s)
+        s.connect((peer_ip, peer_port))
+    except Exception:
+        s.close()
+        raise
+    return s
 
 # ----------------------------------------------------------------------------------
-# This function (download_chunk) is used to download a specific chunk from the peer
-def download_chunk(peer_ip, peer_port, chunk_name):
+# This function (request_chunks_from_peer) asks a peer for the chunks it has over an
+# open connection
+def request_chunks_from_peer(s, peer_ip, peer_port):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((peer_ip, peer_port))
-
-            # Send a request to download a chunk
-            s.sendall(b'REQUEST_CHUNK')
-            # Receive acknowledgement from the peer
-            ack = s.recv(1024)
-            # Check if the acknowledgement is correct, if not we display error
-            if ack != b'REQUEST_ACK':
-                print(f"{peer_ip}:{peer_port} didn't acknowledge chunk request. Got: {ack}")
-                return False
-
-            # Send the chunk name to the peer
-            s.sendall(chunk_name.encode())
-            # Define the path to save the chunk
-            save_path = os.path.join(DOWNLOAD_DIR, chunk_name)
-            # Open the file in write mode
-            with open(save_path, 'wb') as f:
-                # Receive the first part of the chunk data
-                first_data = s.recv(1024)
-                # Check if the chunk was not found on the peer
-                if first_data == b'NOT_FOUND':
-                    # Print error in that case
-                    print(f"{chunk_name} not found on {peer_ip}:{peer_port}")
-                    # Remove the empty file
-                    os.remove(save_path)  
-                    return False
-
-
-                # Otherwise, it is the first chunk of data and we write it
-                f.write(first_data)
-                
-                # Continue receiving data until not data when we break
-                while True:
-                    try:
-                        data = s.recv(1024)
-                        if not data:
-                            break
-                        f.write(data)
-                    except:
-                        break
-
-            # Verify the chunk is not empty and if it empty, we return false
-            if os.path.getsize(save_path) == 0:
-                print(f"Downloaded empty chunk: {chunk_name}")
-                os.remove(save_path)
-                return False
-
-            # Return True if the chunk was downloaded successfully.
-            print(f"Downloaded: {chunk_name} from {peer_ip}:{peer_port} ({os.path.getsize(save_path)} bytes)")
-            return True
-
+        # Send a request to get the chunk list
+        s.sendall(pack_message(b'REQUEST_CHUNKS'))  
+        # Receive it
+        chunk_list = recv_manifest(s)
+        # Print the received chunk list
+        print(f"Received chunk list from {peer_ip}:{peer_port}: {chunk_list}")
+        # Return the chunk list.
+        return chunk_list
     except Exception as e:
-        # Return False if the chunk was downloaded successfully.
-        print(f"Error downloading {chunk_name} from {peer_ip}:{peer_port} – {e}")
+        # Print an error message if an exception occurs.
+        print(f"Failed to get chunk list from {peer_ip}:{peer_port} – {e}")
+        return []
+
+# ----------------------------------------------------------------------------------
+# This function (download_chunk) is used to receive the peer's answer for the chunk
+# we asked for next on an open connection and save it. It returns True if the chunk
+# was saved and False if the peer did not have it or it failed the SHA-256 check
+# against "expected_digest". "buf" is a memoryview over a buffer we can receive into,
+# so no new bytes object is created for every piece of data. It is not used (and can
+# be None) when we splice the data straight into the file.
+def download_chunk(s, peer_ip, peer_port, chunk_name, buf, expected_digest=None):
+    # Check if the chunk was not found on the peer
+    status = recv_exact(s, 1)
+    if status == CHUNK_NOT_FOUND:
+        print(f"{chunk_name} not found on {peer_ip}:{peer_port}")
         return False
 
+    # Receive the frame header, it must be for the chunk we asked for
+    name, size = recv_chunk_header(s)
+    if status != CHUNK_FOUND or name != chunk_name:
+        raise ConnectionError(f"Expected {chunk_name}, got status {status} for {name}")
+
+    # Define the path to save the chunk
+    save_path = os.path.join(DOWNLOAD_DIR, os.path.basename(chunk_name))
+    try:
+        # Open the file in read/write mode, so we can hash it after splicing into it
+        with open(save_path, 'w+b') as f:
+            if USE_SPLICE:
+                # Move the chunk data straight from the socket into the file, then
+                # hash what landed there
+                splice_to_file(s, f, size, chunk_name)
+                hexdigest = file_sha256(f, size) if expected_digest is not None else None
+            else:
+                # Receive exactly "size" bytes of chunk data. With RECV_WAITALL the kernel
+                # fills the whole buffer before returning, so a chunk that fits in the
+                # buffer takes a single pass through this loop. We hash the data as it
+                # arrives, while it is still in our buffer, so checking the chunk needs
+                # no second pass over it
+                digest = hashlib.sha256()
+                remaining = size
+                while remaining:
+                    n = s.recv_into(buf, min(len(buf), remaining), RECV_WAITALL)
+                    if not n:
+                        raise ConnectionError(f"Connection closed with {remaining} bytes of {chunk_name} missing")
+                    f.write(buf[:n])
+                    digest.update(buf[:n])
+                    remaining -= n
+                hexdigest = digest.hexdigest()
+    except Exception:
+        # Do not leave half a chunk behind
+        os.remove(save_path)
+        raise
+
+    # Check the chunk against the SHA-256 from the file metadata, if we have it
+    if expected_digest is not None and hexdigest != expected_digest:
+        print(f"{chunk_name} from {peer_ip}:{peer_port} failed the SHA-256 check")
+        os.remove(save_path)
+        return False
+
+    log.debug("Downloaded: %s from %s:%d (%d bytes)", chunk_name, peer_ip, peer_port, size)
+    return True
+
+# ----------------------------------------------------------------------------------
+# This function (download_all_chunks) downloads the given chunks from the peer over
+# an open connection and returns the names of the chunks it saved. "chunk_digests"
+# maps chunk names to their expected SHA-256, for the chunks we can check.
+def download_all_chunks(s, peer_ip, peer_port, chunk_names, chunk_digests=None):
+    downloaded = []
+    try:
+        # Send the request to download chunks together with the list of chunks we
+        # want, in one write. We do not wait for the acknowledgement in between: the
+        # peer reads the list right after acknowledging, so it is fine for it to be
+        # waiting there already, and this saves a round trip per batch. The peer
+        # answers each chunk in the same order
+        send_parts(s, [pack_message(b'REQUEST_CHUNK'), *manifest_parts(chunk_names)])
+        # Receive acknowledgement from the peer
+        ack = recv_message(s)
+        # Check if the acknowledgement is correct, if not we display error
+        if ack != b'REQUEST_ACK':
+            raise ConnectionError(f"didn't acknowledge chunk request. Got: {ack}")
+        # One receive buffer is reused for every chunk. When we splice, the data never
+        # comes into Python, so we do not need one at all
+        with nullcontext() if USE_SPLICE else recv_pool.buffer() as buf:
+            for chunk_name in chunk_names:
+                # Once we have digests, a chunk the metadata does not list can never
+                # pass the check (an empty digest matches nothing)
+                expected_digest = chunk_digests.get(chunk_name, "") if chunk_digests else None
+                if download_chunk(s, peer_ip, peer_port, chunk_name, buf, expected_digest):
+                    downloaded.append(chunk_name)
+
+    except Exception as e:
+        # Keep whatever we managed to download before the error. The connection is
+        # out of step with the peer now, so it cannot be used again
+        print(f"Error downloading chunks from {peer_ip}:{peer_port} – {e}")
+        s.close()
+    return downloaded
+
 # ---------------------------------------------------------------------------------------
 # This helper function (get_file_metadata) is used to read metadata file to get
 # original filename and extension
@@ -152,6 +223,30 @@ def get_file_metadata():
         print(f"Error reading metadata: {e}")
         return None
 
+# -------------------------------------------------------------------------------------
+# This helper function (append_chunk) copies a whole chunk file onto the end of the
+# output file. On Linux sendfile() does the copy inside the kernel. Elsewhere, or if
+# the filesystem refuses sendfile(), we copy through one reusable 1 MB buffer instead
+# of reading the whole chunk into memory.
+def append_chunk(output, chunk_file, size):
+    offset = 0
+    if USE_SENDFILE:
+        # sendfile() writes to the file descriptor directly, so anything still
+        # sitting in Python's write buffer has to go out first
+        output.flush()
+        try:
+            while offset < size:
+                sent = os.sendfile(output.fileno(), chunk_file.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            pass
+    # Copy whatever sendfile() did not
+    if offset < size:
+        chunk_file.seek(offset)
+        shutil.copyfileobj(chunk_file, output, length=COPY_BUFFER_SIZE)
+
 # -------------------------------------------------------------------------------------
 # This function (reconstruct_file) reconstructs the file from chunks using metadata
 def reconstruct_file():
@@ -171,9 +266,20 @@ def reconstruct_file():
         output_path = os.path.join(DOWNLOAD_DIR, original_filename)
         print(f"Using original filename: {original_filename}")
     
-    # Find all chunk files and sort them (excluding the metadata file)
-    chunk_files = sorted([f for f in os.listdir(DOWNLOAD_DIR) 
-                         if f.startswith("chunk_") and f.endswith(".part")])
+    # Find all chunk files (excluding the metadata file) and sort them by their number,
+    # so chunk_10 is added after chunk_9 and not after chunk_1
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        chunk_files = sorted((e.name for e in entries
+                              if e.is_file() and e.name.startswith("chunk_") and e.name.endswith(".part")),
+                             key=lambda name: int(name[6:-5]))
+    # Only use the chunks the metadata lists, if it has the list
+    if metadata and metadata.get("chunk_digests"):
+        chunk_files = [name for name in chunk_files if name in metadata["chunk_digests"]]
+        # Every chunk it lists must be here, otherwise the file would have a hole in it
+        missing = sorted(set(metadata["chunk_digests"]) - set(chunk_files), key=lambda name: int(name[6:-5]))
+        if missing:
+            print(f"Cannot reconstruct the file, missing chunks: {missing}")
+            return False
     
     if not chunk_files:
         print("No chunks found for reconstruction!")
@@ -184,24 +290,44 @@ def reconstruct_file():
     
     # Reconstructing the file
     # Open the output file in write mode
+    output_size = 0
     with open(output_path, "wb") as output:
         # Iterate over each chunk file
         for chunk_name in chunk_files:
             # Define the path to the chunk file
             chunk_path = os.path.join(DOWNLOAD_DIR, chunk_name)
-            print(f"Adding {chunk_name} to reconstructed file ({os.path.getsize(chunk_path)} bytes)")
             # Open the chunk file in read
             with open(chunk_path, "rb") as chunk_file:
-                # Write the chunk data to the output file
-                output.write(chunk_file.read())
+                chunk_size = os.fstat(chunk_file.fileno()).st_size
+                # Each chunk is read once from start to end, so let the kernel read ahead
+                if HAS_FADVISE:
+                    os.posix_fadvise(chunk_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                log.debug("Adding %s to reconstructed file (%d bytes)", chunk_name, chunk_size)
+                # Append the chunk data to the output file
+                append_chunk(output, chunk_file, chunk_size)
+                output_size += chunk_size
+                # The chunk is in the output now, we will not read it again
+                if HAS_FADVISE:
+                    os.posix_fadvise(chunk_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        # Write everything out and tell the kernel it does not need to keep the
+        # output file's pages cached. Pages still waiting to be written are kept
+        # anyway, so this only drops what is already safely on disk
+        output.flush()
+        if HAS_FADVISE:
+            os.posix_fadvise(output.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
     
     # Check if the reconstructed file is empty and display error if it is
-    if os.path.getsize(output_path) == 0:
+    if output_size == 0:
         print("Warning: Reconstructed file is empty!")
         return False
     
+    # Check the reconstructed file is as long as the original
+    if metadata and metadata.get("chunk_digests") and output_size != metadata.get("size"):
+        print(f"Reconstructed file is {output_size} bytes, expected {metadata.get('size')} bytes!")
+        return False
+    
     # Print a success message
-    print(f"\nReconstructed file saved as: {output_path} ({os.path.getsize(output_path)} bytes)")
+    print(f"\nReconstructed file saved as: {output_path} ({output_size} bytes)")
     return True
 
 # ----------------------------------------------------------------------------------
@@ -210,68 +336,115 @@ def main():
     print("Starting Bob's file retrieval process...")
     
     # Clean download directory from previous work
-    # Iterate over each file in the download directory and define path
-    for filename in os.listdir(DOWNLOAD_DIR):
-        file_path = os.path.join(DOWNLOAD_DIR, filename)
-        try:
-            # Check if the file is a regular file, then remove it 
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            # Else error
-            print(f"Error cleaning up {filename}: {e}")
+    # Iterate over each entry in the download directory
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        for entry in entries:
+            try:
+                # Check if the entry is a regular file, then remove it 
+                if entry.is_file():
+                    os.remove(entry.path)
+            except Exception as e:
+                # Else error
+                print(f"Error cleaning up {entry.name}: {e}")
     
     # Get all available peers from tracker
-    all_peers = get_peer_list()
+    peers = get_peer_list()
     # Check if the peer list is empty, then display error and return
-    if not all_peers:
+    if not peers:
         print("No peers available. Make sure the tracker is running and peers are registered.")
         return
 
      # Print the number of peers found
-    print(f"Found {len(all_peers)} peers: {all_peers}")
+    print(f"Found {len(peers)} peers: {peers}")
     
     # Keep track of downloaded chunks by making a set
     downloaded_chunks = set()
-    
-    # Process each peer
-    for peer in all_peers:
-        # Split the peer address into IP and port
-        ip, port = peer.split(":")
-         # Convert the port to integer
-        port = int(port)
-        # Print a message indicating which peer is being contacted.
-        print(f"\nContacting peer at {ip}:{port}...")
-        
-        # Get available chunks from this peer
-        available_chunks = request_chunks_from_peer(ip, port)
-        
-        # If no available chunks, print that
-        if not available_chunks:
-            print(f"No chunks available from {ip}:{port}")
-            # Continue to the next peer.
-            continue
-            
-        # Print the number of chunks available from the peer.
-        print(f"Peer has {len(available_chunks)} chunks: {available_chunks}")
-        
-        # Download each chunk
-        for chunk in available_chunks:
-            # Check if the chunk has not been downloaded yet.
-            if chunk not in downloaded_chunks:
-                # Print a message indicating which chunk is being downloaded.
-                print(f"Attempting to download {chunk}...")
-                # Download the chunk.
-                success = download_chunk(ip, port, chunk)
-                # Check if the chunk was downloaded successfully.
-                if success:
-                    # Add the chunk to the set of downloaded chunks.
-                    downloaded_chunks.add(chunk)
-                    # Success msg.
-                    print(f"Successfully downloaded {chunk}")
-                else:
-                    # Failure msg
-                    print(f"Failed to download {chunk}")
+
+    # Open connections, keyed by peer
+    connections = {}
+
+    # This helper function (contact_peer) connects to a peer and gets its chunk list
+    def contact_peer(peer):
+        try:
+            connections[peer] = open_peer(*peer)
+        except Exception as e:
+            print(f"Failed to connect to {peer[0]}:{peer[1]} – {e}")
+            return []
+        return request_chunks_from_peer(connections[peer], *peer)
+
+    # Talk to all the peers at the same time, so we get the combined bandwidth of
+    # every peer instead of downloading from one after another
+    with ThreadPoolExecutor(max_workers=len(peers)) as pool:
+        # Get available chunks from every peer
+        print(f"\nContacting {len(peers)} peers...")
+        chunk_lists = list(pool.map(contact_peer, peers))
+
+        # Work out which peers have each chunk
+        holders = {}
+        for (ip, port), available_chunks in zip(peers, chunk_lists):
+            # If no available chunks, print that
+            if not available_chunks:
+                print(f"No chunks available from {ip}:{port}")
+                continue
+            # Print the number of chunks available from the peer.
+            print(f"Peer {ip}:{port} has {len(available_chunks)} chunks: {available_chunks}")
+            for chunk in available_chunks:
+                holders.setdefault(chunk, []).append((ip, port))
+
+        # Get the file metadata before anything else. It has the SHA-256 of every
+        # chunk, which lets us check each chunk while we download it
+        chunk_digests = {}
+        metadata_peers = holders.get("file_metadata.json", [])
+        while metadata_peers and "file_metadata.json" not in downloaded_chunks:
+            peer = metadata_peers.pop(0)
+            downloaded_chunks.update(download_all_chunks(connections[peer], *peer, ["file_metadata.json"]))
+        if "file_metadata.json" in downloaded_chunks:
+            metadata = get_file_metadata()
+            if metadata:
+                chunk_digests = metadata.get("chunk_digests", {})
+
+        # If the metadata lists the chunks, those are the only ones we want. Anything
+        # else a peer has (like a chunk left over from an earlier, bigger file) would
+        # only corrupt the file we rebuild
+        if chunk_digests:
+            for chunk in holders:
+                if chunk not in chunk_digests and chunk != "file_metadata.json":
+                    print(f"Ignoring {chunk}, it is not part of the file")
+            holders = {chunk: chunk_peers for chunk, chunk_peers in holders.items()
+                       if chunk in chunk_digests or chunk == "file_metadata.json"}
+
+        # Each round, give every chunk we still need to one of the peers that has it
+        # (the one with the fewest chunks so far) and download from all of them at
+        # once. Chunks that fail are tried again on another peer in the next round.
+        pending = {chunk: chunk_peers for chunk, chunk_peers in holders.items()
+                   if chunk not in downloaded_chunks and chunk_peers}
+        while pending:
+            assignments = {}
+            for chunk, chunk_peers in pending.items():
+                peer = min(chunk_peers, key=lambda p: len(assignments.get(p, [])))
+                chunk_peers.remove(peer)
+                assignments.setdefault(peer, []).append(chunk)
+
+            for (ip, port), chunks in assignments.items():
+                print(f"Attempting to download {len(chunks)} chunks from {ip}:{port}...")
+            results = pool.map(lambda item: download_all_chunks(connections[item[0]], *item[0], item[1],
+                                                                chunk_digests),
+                               assignments.items())
+            for downloaded in results:
+                # Add the chunks to the set of downloaded chunks.
+                downloaded_chunks.update(downloaded)
+
+            pending = {chunk: chunk_peers for chunk, chunk_peers in pending.items()
+                       if chunk not in downloaded_chunks and chunk_peers}
+
+    # We are done with the peers
+    for s in connections.values():
+        s.close()
+
+    # Failure msg for anything no peer could send
+    for chunk in holders:
+        if chunk not in downloaded_chunks:
+            print(f"Failed to download {chunk}")
 
     # If no chunks were downloaded, display
     if not downloaded_chunks:
@@ -289,6 +462,9 @@ def main():
 
 # ----------------------------------------------------------------------------------
 if __name__ == "__main__":
+    # Show the per-chunk messages if asked to
+    if "--verbose" in sys.argv:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     # Call main function 
     main()
 
@@ -0,0 +1,46 @@
+# This is the BUFFER POOL module for our file-sharing system.
+# Bob receives chunk data into buffers when he cannot splice it straight to disk.
+# Instead of allocating a new buffer for every download, he borrows one from a pool
+# and gives it back when he is done, so the same memory is used over and over.
+
+# Import necessary libraries
+import queue
+from contextlib import contextmanager
+
+# ---------------------------------------------------------------------------------------------
+# This class (BufferPool) hands out reusable buffers of one size. Buffers are only
+# allocated when nobody has given one back yet, so the caller never has to wait, and
+# the pool keeps at most "count" free buffers (extra ones given back are dropped).
+# The buffers are handed out as memoryviews, so slicing them does not copy.
+# It is safe to use from several threads at once.
+class BufferPool:
+    def __init__(self, size, count):
+        self.size = size
+        # Last in, first out, so the buffer that was used most recently (and is most
+        # likely still in the CPU cache) is handed out first
+        self._free = queue.LifoQueue(maxsize=count)
+
+    # This method (get) takes a buffer from the pool
+    def get(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return memoryview(bytearray(self.size))
+
+    # This method (put) gives a buffer back to the pool
+    def put(self, buf):
+        try:
+            self._free.put_nowait(buf)
+        except queue.Full:
+            pass
+
+    # This method (buffer) lends a buffer for the length of a "with" block:
+    #     with pool.buffer() as buf:
+    #         n = sock.recv_into(buf)
+    @contextmanager
+    def buffer(self):
+        buf = self.get()
+        try:
+            yield buf
+        finally:
+            self.put(buf)
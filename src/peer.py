@@ -9,12 +9,46 @@
 # Import necessary libraries
 import socket  
 import os  
+import logging
+import mmap
+import queue
+import sys
 import threading  
 import shutil  
-import json 
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 
-# First, we remove any existing received_chunks directory contents
-shutil.rmtree("received_chunks", ignore_errors=True)
+from protocol import (CHUNK_FOUND, CHUNK_NOT_FOUND, RECV_WAITALL, USE_SPLICE, file_sha256,
+                      load_json, pack_chunk_header, pack_manifest, pack_message, recv_chunk_header, recv_manifest,
+                      recv_message, send_parts, set_cork, splice_to_file, tune_socket)
+
+# ---------------------------------------------------------------------------------------
+# This function (remove_dirs) deletes the given directories and everything in them
+def remove_dirs(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+# ---------------------------------------------------------------------------------------
+# This function (clear_received_chunks) gives us an empty received_chunks directory.
+# Deleting every chunk from a previous run can take a while, so we only rename the old
+# directory out of the way (which is instant) and delete it in a background thread
+# while the peer starts up. Old directories whose deletion was cut short when an
+# earlier peer exited are deleted along with it.
+def clear_received_chunks():
+    try:
+        os.rename("received_chunks", f"received_chunks.stale.{time.time_ns()}")
+    except FileNotFoundError:
+        pass
+    os.makedirs("received_chunks", exist_ok=True)
+    with os.scandir('.') as entries:
+        stale_dirs = [entry.path for entry in entries
+                      if entry.name.startswith("received_chunks.stale.") and entry.is_dir()]
+    if stale_dirs:
+        threading.Thread(target=remove_dirs, args=(stale_dirs,), daemon=True).start()
+
+# First, we clear out the received_chunks directory from a previous run
+clear_received_chunks()
 
 # Peer's IP address
 PEER_IP = '127.0.0.1'
@@ -23,6 +57,26 @@ TRACKER_IP = '127.0.0.1'
 # Tracker's port
 TRACKER_PORT = 9090
 
+# Logger for the messages we print for every request and chunk. They are hidden unless
+# the peer is started with --verbose, so serving many chunks is not slowed down by
+# thousands of lines
+log = logging.getLogger(__name__)
+
+# Number of connections the peer serves at the same time. Connections beyond this
+# wait in the pool's queue until a worker is free
+PEER_WORKERS = 64
+
+# The chunk list we last sent, packed and ready to send again, and the modification
+# time of received_chunks when we made it. The directory's mtime changes whenever a
+# chunk is added or removed, so as long as it stays the same the list is still right.
+_chunk_list_cache = {"mtime_ns": None, "packed": None}
+# Lock that guards _chunk_list_cache, since every connection has its own thread
+_chunk_list_lock = threading.Lock()
+# Some filesystems only update mtimes every few milliseconds, so a chunk saved just
+# after we listed the directory might not change it. We do not cache a listing of a
+# directory that changed less than this long ago (in nanoseconds)
+CHUNK_LIST_SETTLE_NS = 1_000_000_000
+
 # ---------------------------------------------------------------------------------------
 # This function (get_free_port) finds and returns an available port number for the peer to 
 # communicate. 
@@ -52,7 +106,7 @@ def register_with_tracker():
             # Create the registration message
             register_msg = f"REGISTER_PEER {PEER_IP}:{PEER_PORT}"
             # Send it
-            s.sendall(register_msg.encode())
+            s.sendall(pack_message(register_msg.encode()))
             # Print it for the user 
             print(f"Tracker registration complete: {register_msg}")
         except Exception as e:
@@ -62,54 +116,68 @@ def register_with_tracker():
 
 # ----------------------------------------------------------------------------------
 # This function (start_peer) is used to start the peer server to listen for incoming connections
+# Every connection is served by a worker thread with plain blocking calls. This is on
+# purpose: the calls that move chunk data (recv_into() with MSG_WAITALL, sendfile())
+# handle a whole chunk at a time and release the GIL while they wait, so the threads
+# spend their time in the kernel, not in Python. An asyncio server would copy every
+# chunk through its stream buffers, and uvloop has no sendfile() at all.
 def start_peer():
     # Call the register function we made to register with tracker first
     register_with_tracker()
     # Now, we create the server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Tune it for chunk transfers before listening, so accepted connections offer the
+    # large receive window right from the handshake
+    tune_socket(server_socket)
     # Bind to the peer's IP and port
     server_socket.bind((PEER_IP, PEER_PORT))
-    # Listen for incoming connections
-    server_socket.listen(5)
+    # Listen for incoming connections (we can queue upto 128 of them)
+    server_socket.listen(128)
     # Print peer running message so the user is aware that the peer is up
     print(f"Peer is now running at {PEER_IP}:{PEER_PORT} and waiting for chunks...")
-    # Next, we ensure that the received_chunks directory exists
-    os.makedirs('received_chunks', exist_ok=True)
-    while True:
-        try:
-            # Accept a connection
-            connection, addr = server_socket.accept()
-            # Print new connection info 
-            print(f"New connection from {addr}")
-            # Start thread for client
-            threading.Thread(target=handle_client, args=(connection,)).start()
-        except Exception as e:
-            # In case of a connection error, we print it
-            print(f"Error accepting connection: {e}")
+    # Serve connections on a fixed set of worker threads instead of starting a new
+    # thread for every connection
+    with ThreadPoolExecutor(max_workers=PEER_WORKERS, thread_name_prefix='peer-io') as pool:
+        while True:
+            try:
+                # Accept a connection
+                connection, addr = server_socket.accept()
+                # Make sure the connection has the chunk transfer settings too
+                tune_socket(connection)
+                # Print new connection info 
+                print(f"New connection from {addr}")
+                # Hand the client to a worker thread
+                pool.submit(handle_client, connection)
+            except Exception as e:
+                # In case of a connection error, we print it
+                print(f"Error accepting connection: {e}")
 
 # ----------------------------------------------------------------------------------
-# This function (handle_client) is used to handle communication with a connected client
+# This function (handle_client) is used to handle communication with a connected client.
+# A client can send several requests over the same connection (Bob lists our chunks
+# and then downloads them without reconnecting), so we keep serving requests until
+# the client closes the connection or a request fails.
 def handle_client(connection):
     try:
-        # Get request type
-        request = connection.recv(1024)
-        # Print the received request
-        print(f"Received request: {request}")
-        # Handle chunk request
-        if request == b'REQUEST_CHUNKS':
-            # Call handler function
-            handle_request_chunks(connection)
-        # Handle specific chunk request
-        elif request == b'REQUEST_CHUNK': 
-            handle_request_specific_chunk(connection)
-        # Handle incoming chunk
-        elif request == b'READY_TO_SEND':
-            # Call appropriate function
-            handle_incoming_chunk(connection)
-        else:
-            # Handle unknown requests
-            print(f"Unknown request: {request}")
+        while True:
+            # Get request type, stop if the client is done
+            request = recv_message(connection)
+            if not request:
+                break
+            # Print the received request
+            log.debug("Received request: %s", request)
+            # Look up the handler for this request (see REQUEST_HANDLERS) and call it
+            handler = REQUEST_HANDLERS.get(request)
+            if handler is not None:
+                ok = handler(connection)
+            else:
+                # Handle unknown requests
+                print(f"Unknown request: {request}")
+                ok = False
+            # After a failed request we can no longer tell where the next one starts
+            if not ok:
+                break
     except Exception as e:
         # Print if error.
         print(f"Error while handling client request: {e}")
@@ -117,46 +185,103 @@ def handle_client(connection):
         # Close the connection
         connection.close()
 
+# ----------------------------------------------------------------------------------
+# This function (recv_to_mmap) receives exactly "size" bytes from the socket into the file.
+# We make the file "size" bytes long and map it, then receive right into the mapping, so
+# the data lands in the page cache with no buffer in between and no write() calls.
+def recv_to_mmap(connection, f, size, chunk_name):
+    f.truncate(size)
+    with mmap.mmap(f.fileno(), size) as mapping:
+        view = memoryview(mapping)
+        try:
+            received = 0
+            while received < size:
+                # With RECV_WAITALL this usually takes the whole chunk in one call
+                n = connection.recv_into(view[received:], 0, RECV_WAITALL)
+                # If the sender went away mid-chunk, give up on the connection
+                if not n:
+                    raise ConnectionError(f"Connection closed with {size - received} bytes of {chunk_name} missing")
+                received += n
+        finally:
+            # The map cannot be closed while a view of it is still open
+            view.release()
+
 # ----------------------------------------------------------------------------------
 # This function (handle_incoming_chunk) is used to handle the logic for receiving
-# a chunk of data from another peer.
+# chunks of data from another peer. The sender first sends a manifest of the chunks,
+# then streams every chunk over this one connection as a frame (see protocol.py).
 def handle_incoming_chunk(connection):
     try:
         # Send acknowledgment
-        connection.sendall(b'READY_ACK')
-        # Get chunk filename
-        chunk_file_name = connection.recv(1024).decode()
-        # Print incoming chunk name
-        print(f"Incoming chunk name: {chunk_file_name}")
+        connection.sendall(pack_message(b'READY_ACK'))
         # Set the save directory
         save_dir = 'received_chunks'
-        os.makedirs(save_dir, exist_ok=True)
-        # Construct the full save path
-        save_path = os.path.join(save_dir, chunk_file_name)
-        # Open the file for writing 
-        with open(save_path, 'wb') as f:
-            while True:
-                try:
-                    # Receive data
-                    data = connection.recv(1024)
-                    # If no more data, break
-                    if not data:
-                        break
-                    # Write data to the file
-                    f.write(data)
-                except ConnectionResetError:
-                    print("Connection reset during chunk receive – assuming file end.")
-                    break
-        # Verify file received
-        if os.path.exists(save_path) and os.path.getsize(save_path) > 0:
-            # Print success message to infrom user
-            print(f"Saved chunk: {chunk_file_name} ({os.path.getsize(save_path)} bytes)")
-        else:
-            # Print warning in case of an error
-            print(f"Warning: Chunk {chunk_file_name} is empty or wasn't saved properly")
+        # Get the list of chunks the sender is about to send
+        manifest = recv_manifest(connection)
+        print(f"Incoming manifest: {len(manifest)} chunks")
+        # Names of the chunks we saved from this manifest
+        received = []
+        for _ in manifest:
+            # Get chunk filename and data size
+            chunk_file_name, size = recv_chunk_header(connection)
+            chunk_file_name = os.path.basename(chunk_file_name)
+            # Print incoming chunk name
+            log.debug("Incoming chunk name: %s (%d bytes)", chunk_file_name, size)
+            # Construct the full save path
+            save_path = os.path.join(save_dir, chunk_file_name)
+            # Open the file for writing (and reading, so it can be mapped)
+            try:
+                with open(save_path, 'w+b') as f:
+                    # On Linux, move the data straight from the socket into the file. It
+                    # never comes up into Python, and a whole pipe-full is moved with two calls
+                    if USE_SPLICE:
+                        splice_to_file(connection, f, size, chunk_file_name)
+                    # Elsewhere, receive it straight into the file's memory map
+                    elif size:
+                        recv_to_mmap(connection, f, size, chunk_file_name)
+            except Exception:
+                # Do not leave half a chunk behind, we would offer it to Bob
+                os.remove(save_path)
+                raise
+            # Verify file received
+            if os.path.exists(save_path) and os.path.getsize(save_path) > 0:
+                # Print success message to infrom user
+                log.debug("Saved chunk: %s (%d bytes)", chunk_file_name, os.path.getsize(save_path))
+                received.append(chunk_file_name)
+            else:
+                # Print warning in case of an error
+                print(f"Warning: Chunk {chunk_file_name} is empty or wasn't saved properly")
+        # The metadata comes last and holds every chunk's SHA-256, check what we got
+        if "file_metadata.json" in received:
+            verify_chunks(save_dir, received)
+        return True
     except Exception as e:
         # Print chunk receiving error
         print(f"Error while receiving chunk: {e}")
+        return False
+
+# ----------------------------------------------------------------------------------
+# This function (verify_chunks) checks the given chunks in save_dir against the SHA-256
+# digests in the file metadata, and deletes any chunk that does not match or that the
+# metadata does not list, so we never hand a damaged or stray chunk to Bob.
+def verify_chunks(save_dir, chunk_names):
+    with open(os.path.join(save_dir, "file_metadata.json"), "rb") as f:
+        chunk_digests = load_json(f.read()).get("chunk_digests", {})
+    for chunk_name in chunk_names:
+        # The metadata file itself has no digest
+        if chunk_name == "file_metadata.json":
+            continue
+        chunk_path = os.path.join(save_dir, chunk_name)
+        expected_digest = chunk_digests.get(chunk_name)
+        if expected_digest is None:
+            print(f"Chunk {chunk_name} is not listed in the metadata, deleting it")
+            os.remove(chunk_path)
+            continue
+        with open(chunk_path, "rb") as f:
+            digest = file_sha256(f, os.fstat(f.fileno()).st_size)
+        if digest != expected_digest:
+            print(f"Chunk {chunk_name} is corrupted (SHA-256 mismatch), deleting it")
+            os.remove(chunk_path)
 
 # ---------------------------------------------------------------------------------- 
 # This function is relevant for the Part 2 of the Assignment, when we retrieve the file
@@ -166,61 +291,113 @@ def handle_request_chunks(connection):
     try:
         if not os.path.exists('received_chunks'):
             os.makedirs('received_chunks')
-            connection.sendall(json.dumps([]).encode())
+            connection.sendall(pack_manifest([]))
             print("Sent empty chunk list (no folder yet)")
-            return
-        # Get the chunk list
-        available_chunks = [f for f in os.listdir('received_chunks') if os.path.isfile(os.path.join('received_chunks', f))]
-        # Convert list to JSON
-        response = json.dumps(available_chunks)
-        # Send the JSON-encoded list
-        connection.sendall(response.encode())
+            return True
+        # Reuse the list we sent last time if no chunk has been added or removed since
+        mtime_ns = os.stat('received_chunks').st_mtime_ns
+        with _chunk_list_lock:
+            if _chunk_list_cache["mtime_ns"] == mtime_ns:
+                packed = _chunk_list_cache["packed"]
+            else:
+                packed = None
+        if packed is not None:
+            connection.sendall(packed)
+            print("Sent available chunks list (unchanged)")
+            return True
+        # Get the chunk list. scandir() tells us which entries are files from the
+        # directory listing itself, so we do not have to stat() every chunk
+        with os.scandir('received_chunks') as entries:
+            available_chunks = [entry.name for entry in entries if entry.is_file()]
+        # Pack the list as a length-prefixed JSON manifest, so it can be any size
+        packed = pack_manifest(available_chunks)
+        # Keep it for next time, unless the directory changed so recently that a chunk
+        # could have been added without moving its mtime
+        if time.time_ns() - mtime_ns >= CHUNK_LIST_SETTLE_NS:
+            with _chunk_list_lock:
+                _chunk_list_cache["mtime_ns"] = mtime_ns
+                _chunk_list_cache["packed"] = packed
+        # Send it
+        connection.sendall(packed)
         # Print sent list
-        print(f"Sent available chunks list: {available_chunks}")
+        print(f"Sent available chunks list: {len(available_chunks)} chunks")
+        log.debug("Chunks in the list: %s", available_chunks)
+        return True
     except Exception as e:
         # Print error
         print(f"Error sending chunk list: {e}")
-        try:
-            connection.sendall(json.dumps([]).encode())
-        except:
-            pass
+        return False
 
 # ----------------------------------------------------------------------------------
-# This function (handle_request_specific_chunk) is used to send a specific chunk to Bob
+# This function (handle_request_specific_chunk) is used to send the chunks Bob asks for.
+# Bob sends a manifest with the names he wants and we answer each name, in the same
+# order, over this one connection: a status byte and, if we have the chunk, its frame
+# (see protocol.py).
 def handle_request_specific_chunk(connection):
     try:
         # Send acknowledgment
-        connection.sendall(b'REQUEST_ACK')
-        # Get requested chunk name
-        chunk_name = connection.recv(1024).decode()
+        connection.sendall(pack_message(b'REQUEST_ACK'))
+        # Get requested chunk names
+        chunk_names = recv_manifest(connection)
         # Print request
-        print(f"Received request for chunk: {chunk_name}")
-        # Construct path
-        chunk_path = os.path.join('received_chunks', chunk_name)
-        # Check if chunk exists
-        if not os.path.exists(chunk_path) or os.path.getsize(chunk_path) == 0:
-            # Send not found
-            connection.sendall(b'NOT_FOUND')
-            # Print not found
-            print(f"{chunk_name} not found or empty")
-            return
-        # Open the chunk file
-        with open(chunk_path, 'rb') as f:
-            # Read the chunk data
-            data = f.read()
-            # Send the data
-            connection.sendall(data)
-            # Print when it is sent
-            print(f"Sent chunk {chunk_name} ({len(data)} bytes)")
+        print(f"Received request for {len(chunk_names)} chunks")
+        log.debug("Requested chunks: %s", chunk_names)
+        # Cork the socket while we answer, so every status byte and frame header goes
+        # out together with the chunk data instead of in a tiny segment of its own
+        set_cork(connection, True)
+        for chunk_name in chunk_names:
+            # Construct path
+            chunk_path = os.path.join('received_chunks', os.path.basename(chunk_name))
+            # Check if chunk exists
+            if not os.path.exists(chunk_path) or os.path.getsize(chunk_path) == 0:
+                # Send not found
+                connection.sendall(CHUNK_NOT_FOUND)
+                # Print not found
+                print(f"{chunk_name} not found or empty")
+                continue
+            # Open the chunk file
+            with open(chunk_path, 'rb') as f:
+                # Get the chunk size
+                size = os.fstat(f.fileno()).st_size
+                # Send the status and frame header
+                send_parts(connection, [CHUNK_FOUND, pack_chunk_header(chunk_name, size)])
+                # Send the data straight from the file with sendfile(), so it is never
+                # read into Python (socket.sendfile() falls back to send() where the
+                # system has no sendfile())
+                sent = connection.sendfile(f, 0, size)
+                # The header promised "size" bytes, if we sent fewer the frames no longer line up
+                if sent != size:
+                    raise ConnectionError(f"Sent only {sent} of {size} bytes of {chunk_name}")
+                # Print when it is sent
+                log.debug("Sent chunk %s (%d bytes)", chunk_name, size)
+        # Send whatever the cork is still holding back
+        set_cork(connection, False)
+        return True
     except Exception as e:
-        # Print error
+        # Print error. Bob notices the missing frames when we close the connection
         print(f"Error sending chunk: {e}")
-        try:
-            connection.sendall(b'NOT_FOUND')
-        except:
-            pass
+        return False
+
+# ----------------------------------------------------------------------------------
+# The handler for every request a client can send. Each one returns True if the
+# connection can be used for another request afterwards
+REQUEST_HANDLERS = {
+    # Bob asks for the list of chunks we have
+    b'REQUEST_CHUNKS': handle_request_chunks,
+    # Bob asks for specific chunks
+    b'REQUEST_CHUNK': handle_request_specific_chunk,
+    # Alice is about to send us chunks
+    b'READY_TO_SEND': handle_incoming_chunk,
+}
 
 # ----------------------------------------------------------------------------------
 # Call the star_peer function in the main loop 
 if __name__ == "__main__":
+    # Show the per-request and per-chunk messages if asked to. The worker threads only
+    # put their messages on a queue, and a background thread writes them out, so
+    # a slow terminal never holds up a transfer
+    if "--verbose" in sys.argv:
+        log_queue = queue.SimpleQueue()
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s", handlers=[QueueHandler(log_queue)])
+        QueueListener(log_queue, logging.StreamHandler()).start()
     start_peer()
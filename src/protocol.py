@@ -0,0 +1,295 @@
+# This is the PROTOCOL module for our file-sharing system.
+# It holds the pieces of the wire format that Alice, Bob and the peers must agree on,
+# so the sender and the receiver of a message can never drift apart.
+
+# Import necessary libraries
+import hashlib
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, we only need it for splice() anyway
+    fcntl = None
+
+try:
+    # orjson encodes and decodes JSON in native code, several times faster than the
+    # json module. It is optional: the two format JSON slightly differently (orjson
+    # leaves out spaces), but either side can decode what the other sends
+    import orjson
+except ImportError:
+    orjson = None
+
+# ---------------------------------------------------------------------------------------------
+# Control messages
+# Requests (READY_TO_SEND, REQUEST_CHUNKS, REQUEST_CHUNK, GET_PEERS, REGISTER_PEER ip:port)
+# and acknowledgements (READY_ACK, REQUEST_ACK) are sent as a frame:
+#     4-byte big-endian length | message
+# TCP does not keep our messages apart: two of them can arrive in one recv(), or one
+# can be split over two. With the length in front, the receiver reads exactly one
+# message every time.
+MESSAGE_LEN = struct.Struct(">I")
+# Longest control message we accept. Anything longer means the two sides are out of step
+MAX_MESSAGE_SIZE = 1024
+
+# ---------------------------------------------------------------------------------------------
+# Bulk transfers
+# Chunks are always moved in bulk, one connection per peer. After the handshake
+# (READY_TO_SEND/READY_ACK for Alice, REQUEST_CHUNK/REQUEST_ACK for Bob) the side that
+# starts the transfer sends a manifest:
+#     4-byte big-endian length | JSON list
+# Alice's manifest lists [name, size] for every chunk she is about to send, Bob's lists
+# the names of the chunks he wants. The chunks then follow back-to-back, in manifest
+# order, each as a frame:
+#     2-byte big-endian name length | 8-byte big-endian data size | name | data
+# Both lengths come first in one fixed-size header, so the receiver always knows exactly
+# how many bytes to read next and never has to wait or guess where a message ends.
+# When a peer answers Bob, every answer starts with a status byte: CHUNK_FOUND followed
+# by the frame, or CHUNK_NOT_FOUND on its own. This keeps "missing" out of the data
+# stream, so any chunk contents (even empty ones) can be sent.
+MANIFEST_LEN = struct.Struct(">I")
+# Longest manifest we accept. The biggest one ever sent is Alice's, with one
+# ["chunk_N.part", size] entry per chunk; an entry is about 30 bytes of JSON, so 64 bytes
+# per entry leaves plenty of room. Allowing MAX_MANIFEST_CHUNKS entries covers files of up
+# to 256 GB (in 1 MB chunks) and means a bad length can never make us allocate more than
+# 16 MB for one manifest
+MAX_MANIFEST_CHUNKS = 256 * 1024
+MAX_MANIFEST_SIZE = 64 * MAX_MANIFEST_CHUNKS
+CHUNK_HEADER = struct.Struct(">HQ")
+CHUNK_FOUND = b'\x00'
+CHUNK_NOT_FOUND = b'\x01'
+
+# ---------------------------------------------------------------------------------------------
+# Peer lists
+# The tracker answers GET_PEERS with a compact binary list instead of JSON text:
+#     2-byte big-endian peer count | (4-byte IPv4 address | 2-byte big-endian port) * count
+PEER_COUNT = struct.Struct(">H")
+PEER_ADDR = struct.Struct(">4sH")
+
+# Size of the chunks Alice splits files into (1 MB)
+CHUNK_SIZE = 1024 * 1024
+
+# Kernel send/receive buffer size for sockets that carry chunk data (4 MB). It holds
+# several whole chunks, so the sender can keep streaming while the receiver is busy
+# writing the previous chunk to disk
+SOCKET_BUFFER_SIZE = 4 * CHUNK_SIZE
+
+# recv() flag asking the kernel to wait until the whole requested length has arrived,
+# so filling a buffer takes one call instead of a Python loop of partial receives.
+# Not every platform has it; there we simply loop
+RECV_WAITALL = getattr(socket, "MSG_WAITALL", 0)
+
+# Linux can splice() data from a socket into a pipe and from the pipe into a file,
+# so chunk data goes straight from the socket to the file without being copied
+# into Python at all
+USE_SPLICE = hasattr(os, "splice") and sys.platform.startswith("linux")
+# Pipes we splice() chunk data through. Each thread gets its own
+_splice_pipes = threading.local()
+
+# ---------------------------------------------------------------------------------------------
+# This function (tune_socket) prepares a socket for chunk transfers. It turns off Nagle's
+# algorithm, so our small handshake and header messages go out straight away instead of
+# waiting for a delayed ACK, and raises the kernel buffers so a whole chunk fits in them.
+# Call it before connect()/listen() so the larger receive window is offered from the
+# start. Accepted sockets inherit the settings of the listening socket on Linux, but
+# not everywhere, so servers call it again on every accepted connection.
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+# ---------------------------------------------------------------------------------------------
+# This function (send_parts) sends several buffers, one after the other, as if they were
+# one. sendmsg() hands all of them to the kernel in a single call, so we neither make
+# one send() per part nor join them into a new bytes object first. Windows has no
+# sendmsg(), so there we join them and use sendall().
+def send_parts(sock, parts):
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b''.join(parts))
+        return
+    views = [memoryview(part) for part in parts if len(part)]
+    while views:
+        sent = sock.sendmsg(views)
+        # sendmsg() may send less than everything. Drop the parts that went out
+        # completely and trim the one it stopped in
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+# ---------------------------------------------------------------------------------------------
+# This function (set_cork) corks or uncorks a socket. While it is corked the kernel holds
+# back partial TCP segments, so a small frame header written just before its data goes
+# out in the same segment as the data instead of on its own. Uncorking sends whatever
+# is still held back. TCP_CORK only exists on Linux; elsewhere this does nothing.
+def set_cork(sock, corked):
+    if hasattr(socket, "TCP_CORK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+
+# ---------------------------------------------------------------------------------------------
+# This function (recv_exact) receives exactly n bytes from the socket.
+# It raises ConnectionError if the connection closes before all of them arrive.
+def recv_exact(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        part = sock.recv_into(view[received:], 0, RECV_WAITALL)
+        if not part:
+            raise ConnectionError(f"Connection closed after {received} of {n} bytes")
+        received += part
+    return data
+
+# ---------------------------------------------------------------------------------------------
+# This function (get_splice_pipe) returns this thread's pipe for splice(), creating it
+# the first time. We ask for a pipe that can hold a whole chunk, so one chunk moves
+# through it in as few calls as possible; if the system refuses, the default size works too.
+def get_splice_pipe():
+    pipe = getattr(_splice_pipes, "pipe", None)
+    if pipe is None:
+        pipe = os.pipe()
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(pipe[1], fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+            except OSError:
+                pass
+        _splice_pipes.pipe = pipe
+    return pipe
+
+# ---------------------------------------------------------------------------------------------
+# This function (drop_splice_pipe) closes this thread's pipe. We do this when a splice()
+# fails, because the pipe might still hold data that belongs to no file.
+def drop_splice_pipe():
+    pipe = getattr(_splice_pipes, "pipe", None)
+    if pipe is not None:
+        _splice_pipes.pipe = None
+        os.close(pipe[0])
+        os.close(pipe[1])
+
+# ---------------------------------------------------------------------------------------------
+# This function (splice_to_file) moves exactly "size" bytes from the socket to the file
+# with splice(), through this thread's pipe. The data never leaves the kernel.
+def splice_to_file(s, f, size, chunk_name):
+    pipe_r, pipe_w = get_splice_pipe()
+    try:
+        remaining = size
+        while remaining:
+            # Socket -> pipe. This takes as much as the pipe has room for
+            n = os.splice(s.fileno(), pipe_w, remaining, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+            if not n:
+                raise ConnectionError(f"Connection closed with {remaining} bytes of {chunk_name} missing")
+            remaining -= n
+            # Pipe -> file. Empty the pipe completely before filling it again
+            while n:
+                n -= os.splice(pipe_r, f.fileno(), n, flags=os.SPLICE_F_MOVE)
+    except Exception:
+        drop_splice_pipe()
+        raise
+
+# ---------------------------------------------------------------------------------------------
+# This function (file_sha256) returns the SHA-256 of the first "size" bytes of an open file.
+# We map the file instead of reading it, so hashlib gets the whole chunk as one buffer
+# straight from the page cache (and lets other threads run while it hashes).
+def file_sha256(f, size):
+    if size == 0:
+        # An empty file cannot be mapped
+        return hashlib.sha256().hexdigest()
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+        return hashlib.sha256(data).hexdigest()
+
+# ---------------------------------------------------------------------------------------------
+# These functions (pack_message, recv_message, read_message) encode and read a control
+# message. recv_message() reads from a socket and returns b'' if the other side closed
+# the connection instead of sending another message; read_message() is the same for an
+# asyncio StreamReader.
+def pack_message(message):
+    return MESSAGE_LEN.pack(len(message)) + message
+
+def recv_message(sock):
+    header = sock.recv(MESSAGE_LEN.size, RECV_WAITALL)
+    if not header:
+        return b''
+    if len(header) < MESSAGE_LEN.size:
+        header += recv_exact(sock, MESSAGE_LEN.size - len(header))
+    (length,) = MESSAGE_LEN.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Control message of {length} bytes is too long")
+    return bytes(recv_exact(sock, length))
+
+async def read_message(reader):
+    (length,) = MESSAGE_LEN.unpack(await reader.readexactly(MESSAGE_LEN.size))
+    if length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Control message of {length} bytes is too long")
+    return await reader.readexactly(length)
+
+# ---------------------------------------------------------------------------------------------
+# These functions (dump_json, load_json) turn a value into JSON bytes and back, with orjson
+# if it is installed and the json module otherwise
+def dump_json(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()
+
+def load_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# ---------------------------------------------------------------------------------------------
+# These functions (manifest_parts, pack_manifest, recv_manifest) encode and read a manifest.
+# manifest_parts() returns the length header and the JSON separately, for send_parts()
+def manifest_parts(entries):
+    payload = dump_json(entries)
+    if len(payload) > MAX_MANIFEST_SIZE:
+        raise ValueError(f"Manifest of {len(payload)} bytes is too long to send")
+    return MANIFEST_LEN.pack(len(payload)), payload
+
+def pack_manifest(entries):
+    return b''.join(manifest_parts(entries))
+
+def recv_manifest(sock):
+    (length,) = MANIFEST_LEN.unpack(recv_exact(sock, MANIFEST_LEN.size))
+    # Check the length before reading, so a bad one cannot make us allocate gigabytes
+    if length > MAX_MANIFEST_SIZE:
+        raise ConnectionError(f"Manifest of {length} bytes is too long")
+    return load_json(recv_exact(sock, length))
+
+# ---------------------------------------------------------------------------------------------
+# These functions (pack_chunk_header, recv_chunk_header) encode and read the header that
+# comes in front of every chunk's data
+def pack_chunk_header(name, size):
+    name = name.encode()
+    return CHUNK_HEADER.pack(len(name), size) + name
+
+def recv_chunk_header(sock):
+    name_len, size = CHUNK_HEADER.unpack(recv_exact(sock, CHUNK_HEADER.size))
+    name = recv_exact(sock, name_len).decode()
+    return name, size
+
+# ---------------------------------------------------------------------------------------------
+# These functions (pack_peer_list, parse_peer_list, recv_peer_list) encode, decode and read
+# a peer list. Peers are (ip, port) tuples.
+def pack_peer_list(peers):
+    parts = [PEER_COUNT.pack(len(peers))]
+    for ip, port in peers:
+        parts.append(PEER_ADDR.pack(socket.inet_aton(ip), port))
+    return b''.join(parts)
+
+def parse_peer_list(buf):
+    (count,) = PEER_COUNT.unpack_from(buf)
+    end = PEER_COUNT.size + count * PEER_ADDR.size
+    return [(socket.inet_ntoa(ip), port)
+            for ip, port in PEER_ADDR.iter_unpack(buf[PEER_COUNT.size:end])]
+
+def recv_peer_list(sock):
+    # Read the count, then exactly the addresses it announces
+    header = recv_exact(sock, PEER_COUNT.size)
+    (count,) = PEER_COUNT.unpack(header)
+    return parse_peer_list(header + recv_exact(sock, count * PEER_ADDR.size))
@@ -8,45 +8,100 @@
 #   3. Allow new peers to register themselves so others can discover them.
 
 import socket
-import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# List to store the registered peers
-peers = []
+from protocol import pack_peer_list, recv_message
 
-# ---------------------------------------------------------------------------------------------
-# This function (start_tracker) handles incoming peer requests.
-def start_tracker(host='0.0.0.0', port=9090):
-    # Create a socket for the tracker to listen for connections
-    tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tracker_socket.bind((host, port))
-    # Start listening for incoming connections (we can queue upto 5 connections)
-    tracker_socket.listen(5)
+# Registered peers, keyed by (ip, port) tuple, with the time they registered.
+# A dict finds a peer in O(1) however many there are, and it keeps the peers in the
+# order they registered, so the peer list we hand out stays the same as before
+peers = {}
+# Lock that guards "peers", since requests are handled by several threads
+peers_lock = threading.Lock()
+# The peer list packed and ready to send. It only changes when a new peer registers,
+# so we pack it then instead of on every GET_PEERS. Bytes never change once made,
+# so GET_PEERS can send it without taking the lock
+packed_peers = pack_peer_list(peers)
 
-    # Let our user know the tracker is running.
-    print(f"Tracker is up and running on {host}:{port}")
+# Number of requests the tracker handles at the same time
+TRACKER_WORKERS = 32
 
-    while True:
-        connection, address = tracker_socket.accept()
-         # Inform the user when we get a connection.
+# ---------------------------------------------------------------------------------------------
+# This function (handle_tracker_client) handles one request from a connected peer.
+# Several of these run at the same time, so "peers" is only touched while holding
+# peers_lock.
+def handle_tracker_client(connection, address):
+    global packed_peers
+    try:
+        # Inform the user when we get a connection.
         print(f"Got a connection from {address}")
-        #  Receive data from the peer (up to 1024 bytes) and decode it.
-        request = connection.recv(1024).decode()
+        #  Receive the request from the peer and decode it.
+        request = recv_message(connection).decode()
         print(f"Request received: {request}")
 
         if request == 'GET_PEERS':
-            # If the peer wants the list of peers, send it the 'peers' list.
-            connection.sendall(json.dumps(peers).encode())
+            # If the peer wants the list of peers, send it the 'peers' list in our
+            # compact binary format (see protocol.py).
+            connection.sendall(packed_peers)
         elif request.startswith('REGISTER_PEER'):
             # If the peer wants to register itself, extract the peer's information.
             # We split the request into two parts: 'REGISTER_PEER' and the peer's info.
             _, peer_info = request.strip().split(' ', 1)
-            # If the peer isn't already in the list, add it. This will help us optimise and
+            ip, peer_port = peer_info.rsplit(':', 1)
+            peer = (ip, int(peer_port))
+            # Peer lists only hold IPv4 addresses and 16-bit ports, so refuse anything
+            # else here. Otherwise one bad registration would break every list we send
+            try:
+                socket.inet_aton(ip)
+            except OSError:
+                print(f"Rejected registration with invalid IP address: {peer_info}")
+                return
+            if not 0 < peer[1] < 65536:
+                print(f"Rejected registration with invalid port: {peer_info}")
+                return
+            # If the peer isn't already registered, add it. This will help us optimise and
             # avoid duplicates
-            if peer_info not in peers:
-                peers.append(peer_info)
+            with peers_lock:
+                is_new = peer not in peers
+                # A peer registering again keeps its place, so only a new one changes the
+                # list. Pack the new list first and only add the peer once that worked,
+                # so "peers" and packed_peers always match
+                if is_new:
+                    new_packed_peers = pack_peer_list([*peers, peer])
+                peers[peer] = time.time()
+                if is_new:
+                    packed_peers = new_packed_peers
+            if is_new:
                 print(f"New peer registered: {peer_info}")
+    except Exception as e:
+        # A bad request only affects this connection, keep the tracker running
+        print(f"Error handling request from {address}: {e}")
+    finally:
         # Close the connection with the peer when we're done with this request
         connection.close()
+
+# ---------------------------------------------------------------------------------------------
+# This function (start_tracker) accepts incoming peer connections and hands each of them
+# to a worker thread, so a slow peer never holds up the others.
+def start_tracker(host='0.0.0.0', port=9090):
+    # Create a socket for the tracker to listen for connections
+    tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tracker_socket.bind((host, port))
+    # Start listening for incoming connections (we can queue upto 64 connections, so a
+    # crowd of peers joining at once is not turned away)
+    tracker_socket.listen(64)
+
+    # Let our user know the tracker is running.
+    print(f"Tracker is up and running on {host}:{port}")
+
+    with ThreadPoolExecutor(max_workers=TRACKER_WORKERS) as pool:
+        while True:
+            connection, address = tracker_socket.accept()
+            # Our replies are small, send them without waiting for Nagle's algorithm
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pool.submit(handle_tracker_client, connection, address)
 # ---------------------------------------------------------------------------------------------
 
 # Main program